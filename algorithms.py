@@ -1,86 +1,231 @@
 import numpy as np
-import random
-import networkx as nx
 import math
+from functools import lru_cache
+from scipy.optimize import linprog
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from network import calculate_overall_delay
 
+# Weight of delay when searching for the cheapest path: too small to reorder paths of different dual cost
+TIE_BREAK_DELAY_WEIGHT = 1e-9
+
+
+@lru_cache(maxsize=None)
+def _path_edges(path):
+    """Return the set of directed (u, v) links traversed by a path given as a tuple of nodes."""
+    return frozenset(zip(path[:-1], path[1:]))
+
 
 def possible_shaping_parameters(flow, T):
     """Compute possible shaping parameters for a flow."""
-    import math
-    MPS = flow.max_pkt_size  
-    bf = flow.burst_size     
-    rf = flow.arrival_rate * 0.000125  # conversion from Mbps to KB/µs
+    return _possible_shaping_parameters(flow.max_pkt_size, flow.burst_size, flow.arrival_rate, T)
+
+
+@lru_cache(maxsize=None)
+def _possible_shaping_parameters(MPS, bf, arrival_rate, T):
+    """Shaping parameters depend only on these scalars, so results are shared across CG iterations."""
+    rf = arrival_rate * 0.000125  # conversion from Mbps to KB/µs
+    min_chunk = rf * T
+    # Both ceil(bf / n) and the parameter MPS * ceil(bf / (n * MPS)) are non-increasing in n,
+    # so duplicates are adjacent and the values come out in descending order.
+    B_f = []
     n = 1
-    B_f = set() 
-    prev_ceil_value = float('inf')
+    prev_ceil_value = math.inf
     while True:
         ceil_value = math.ceil(bf / n)
-        if ceil_value >= (rf * T):
-            possible_param = MPS * math.ceil(bf / (n * MPS))
-            B_f.add(possible_param)
-        else:
-            break  
+        if ceil_value < min_chunk:
+            break
+        possible_param = MPS * math.ceil(bf / (n * MPS))
+        if not B_f or possible_param != B_f[-1]:
+            B_f.append(possible_param)
         if ceil_value >= prev_ceil_value:
             break
         prev_ceil_value = ceil_value
         n += 1
-    return sorted(B_f)
+    B_f.reverse()
+    return tuple(B_f)
+
+
+def arc_dual_costs(network, dual_costs):
+    """Dual cost of each CSR entry of the network, i.e. of each link in each direction."""
+    if network.node_index is None:
+        network.finalize()
+    costs = np.fromiter((dual_costs.get(arc, 0) for arc in network.arcs), dtype=float, count=len(network.arcs))
+    # The LP can report tiny negative duals; Dijkstra needs non-negative weights
+    return np.maximum(costs, 0.0)
+
+
+def cheapest_path_weights(network, arc_costs):
+    """
+    Per-entry weights of the search for the cheapest path by dual cost.
+    Most duals are zero, so paths often tie on cost; a tiny delay term makes the path with the
+    lowest delay among them the unique cheapest one, whatever order Dijkstra visits ties in.
+    """
+    return arc_costs + TIE_BREAK_DELAY_WEIGHT * network.delay_arr[network.edge_ids]
+
+
+def shortest_path_trees(network, arc_weights, sources):
+    """
+    Shortest-path trees from each source over the CSR adjacency, weighted per CSR entry.
+    Returns {source: (distances, predecessors)}, both indexed by contiguous node index.
+    """
+    if network.node_index is None:
+        network.finalize()
+    sources = list(sources)
+    if not sources:
+        return {}
+    num_nodes = len(network.node_ids)
+    graph = csr_matrix((arc_weights, network.indices, network.indptr), shape=(num_nodes, num_nodes))
+    # One compiled Dijkstra run covers every source
+    distances, predecessors = dijkstra(graph, indices=[network.node_index[s] for s in sources],
+                                       return_predecessors=True)
+    return {s: (distances[i], predecessors[i]) for i, s in enumerate(sources)}
+
 
+def tree_path(network, tree, destination):
+    """Read the path to destination off a shortest-path tree, or None if it is unreachable."""
+    distances, predecessors = tree
+    node = network.node_index[destination]
+    if np.isinf(distances[node]):
+        return None
+    path = [node]
+    while predecessors[node] >= 0:
+        node = predecessors[node]
+        path.append(node)
+    return [network.node_ids[i] for i in reversed(path)]
+
+
+def larac_algorithm(network, source, destination, delay_constraint, dual_costs, arc_costs=None,
+                    cheapest_tree=None, fastest_tree=None):
+    """
+    LARAC algorithm for constrained shortest path (CSP).
+    Callers pricing several flows can pass the per-entry dual costs and the shortest-path trees
+    from source by dual cost and by delay, which do not depend on lambda.
+    """
+    if arc_costs is None:
+        arc_costs = arc_dual_costs(network, dual_costs)
+    arc_delays = network.delay_arr[network.edge_ids]
+
+    def cost_and_delay(path):
+        """Return the dual cost and the propagation delay of a path."""
+        hops = list(zip(path[:-1], path[1:]))
+        return sum(dual_costs.get(hop, 0) for hop in hops), sum(network.graph[u][v]['delay'] for u, v in hops)
 
-def larac_algorithm(graph, source, destination, delay_constraint, dual_costs):
-    """LARAC algorithm for constrained shortest path (CSP)."""
     def lagrangian_relaxation(lambda_val):
         """Compute the Lagrangian relaxation for a given lambda."""
-        def cost(u, v, edge_data):
-            return dual_costs.get((u, v), 0) + lambda_val * edge_data['delay']
-        path = nx.dijkstra_path(graph, source, destination, weight=cost)
-        total_delay = sum(graph[u][v]['delay'] for u, v in zip(path[:-1], path[1:]))
-        return path, total_delay
-
-    # Binary search for the optimal lambda
-    lambda_low = 0
-    lambda_high = 1e6
-    best_path = None
-    for _ in range(50):  # Limit iterations for convergence
-        lambda_mid = (lambda_low + lambda_high) / 2
-        path, total_delay = lagrangian_relaxation(lambda_mid)
-        if total_delay <= delay_constraint:
-            best_path = path
-            lambda_high = lambda_mid
+        tree = shortest_path_trees(network, arc_costs + lambda_val * arc_delays, [source])[source]
+        path = tree_path(network, tree, destination)
+        return (path,) + cost_and_delay(path)
+
+    # The cheapest path is optimal if it already meets the delay constraint
+    if cheapest_tree is None:
+        cheapest_tree = shortest_path_trees(network, cheapest_path_weights(network, arc_costs), [source])[source]
+    path_c = tree_path(network, cheapest_tree, destination)
+    if path_c is None:
+        return None  # Destination unreachable
+    cost_c, delay_c = cost_and_delay(path_c)
+    if delay_c <= delay_constraint:
+        return path_c
+
+    # If even the fastest path violates the constraint, there is no feasible path
+    if fastest_tree is None:
+        fastest_tree = shortest_path_trees(network, arc_delays, [source])[source]
+    path_d = tree_path(network, fastest_tree, destination)
+    cost_d, delay_d = cost_and_delay(path_d)
+    if delay_d > delay_constraint:
+        return None
+
+    # Keep an infeasible path (path_c) and a feasible path (path_d) and move lambda to the value
+    # at which both have the same Lagrangian cost, until no path improves on that cost
+    while True:
+        lambda_val = (cost_c - cost_d) / (delay_d - delay_c)
+        path, path_cost, path_delay = lagrangian_relaxation(lambda_val)
+        lagrangian_cost = path_cost + lambda_val * path_delay
+        if lagrangian_cost >= cost_c + lambda_val * delay_c - 1e-9:
+            return path_d
+        if path_delay <= delay_constraint:
+            path_d, cost_d, delay_d = path, path_cost, path_delay
         else:
-            lambda_low = lambda_mid
-    return best_path
+            path_c, cost_c, delay_c = path, path_cost, path_delay
+
+
+def prefilter_flows(network, flows, cycle_duration_T, tau):
+    """
+    Split flows into those that may meet their delay bound and those that cannot on any path.
+    A flow is infeasible if even its smallest shaping delay plus the smallest overall delay of any path
+    (propagation, T and τ per hop, as in calculate_overall_delay) exceeds max_e2e_delay.
+    Such flows never yield a column, so only the first list needs to be priced.
+    """
+    if network.node_index is None:
+        network.finalize()
+    # Overall delay of a hop: its propagation delay, one cycle and the τ of the node it enters
+    tau_arr = np.array([tau.get(node, 0.0) for node in network.node_ids])
+    hop_delays = network.delay_arr[network.edge_ids] + cycle_duration_T / 1000 + tau_arr[network.indices]
+    fastest = shortest_path_trees(network, hop_delays, dict.fromkeys(flow.src for flow in flows))
+    feasible, infeasible = [], []
+    for flow in flows:
+        shaping_delays = [math.ceil(flow.burst_size / b_prime) * cycle_duration_T + cycle_duration_T
+                          for b_prime in possible_shaping_parameters(flow, cycle_duration_T)]
+        min_shaping_delay_ms = min(shaping_delays, default=math.inf) / 1000.0
+        min_path_delay = fastest[flow.src][0][network.node_index[flow.dest]]
+        # The tolerance keeps flows whose bound is only exceeded by summation rounding
+        if min_shaping_delay_ms + min_path_delay > flow.max_e2e_delay + 1e-9:
+            infeasible.append(flow)
+        else:
+            feasible.append(flow)
+    return feasible, infeasible
+
+
+def link_capacities(network, cycle_duration_T):
+    """Per-cycle capacity of each link, in the order of network.graph.edges."""
+    return np.array([network.bandwidths[e] * cycle_duration_T for e in network.graph.edges], dtype=float)
 
 
-def solve_rmp(columns, network, cycle_duration_T):
+def solve_rmp(columns, network, cycle_duration_T, capacities=None):
     """Solve the Restricted Master Problem (RMP) using linear programming."""
     if not columns:
         return {}, {e: 0 for e in network.graph.edges}
     c = np.array([-f.arrival_rate for (f, _, _) in columns], dtype=float)  # Negative for maximization
-    A = []
-    b = []
-    for e in network.graph.edges:
-        constraint = [0] * len(columns)
-        for i, (f, p, b_prime) in enumerate(columns):
-            if e in zip(p[:-1], p[1:]):
-                constraint[i] = b_prime
-        A.append(constraint)
-        b.append(network.bandwidths[e] * cycle_duration_T)
-    A = np.array(A, dtype=float)
-    b = np.array(b, dtype=float)
-    from scipy.optimize import linprog
-    result = linprog(c, A_ub=A, b_ub=b, bounds=(0, 1), method='highs')
+    edges = list(network.graph.edges)
+    edge_to_row = {e: i for i, e in enumerate(edges)}
+    # Build the capacity constraint matrix in COO form: one entry per (edge, column) pair on the column's path
+    rows, cols, data = [], [], []
+    for i, (f, p, b_prime) in enumerate(columns):
+        for e in _path_edges(tuple(p)):
+            row = edge_to_row.get(e)
+            if row is not None:
+                rows.append(row)
+                cols.append(i)
+                data.append(b_prime)
+    A = coo_matrix((data, (rows, cols)), shape=(len(edges), len(columns)), dtype=float).tocsr()
+    if capacities is None:
+        capacities = link_capacities(network, cycle_duration_T)
+    # Dual simplex: each CG iteration only adds a few columns to an otherwise unchanged LP
+    result = linprog(c, A_ub=A, b_ub=capacities, bounds=(0, 1), method='highs-ds')
     solution = {(f, tuple(p), b): float(z) for (f, p, b), z in zip(columns, result.x)}
-    dual_vars = {e: -float(dual) for e, dual in zip(network.graph.edges, result.ineqlin.marginals)}
+    dual_vars = {e: -float(dual) for e, dual in zip(edges, result.ineqlin.marginals)}
     return solution, dual_vars
 
 
-def solve_pricing_problem(flow, network, dual_vars, cycle_duration_T, tau):
-    """Solve the pricing problem to find the best path and shaping parameter for a flow."""
+def solve_pricing_problem(flow, network, dual_vars, cycle_duration_T, tau, path_delays=None, arc_costs=None,
+                          cheapest=None, fastest=None):
+    """
+    Solve the pricing problem to find the best path and shaping parameter for a flow.
+    cheapest and fastest optionally map sources to their shortest-path trees by dual cost and by delay.
+    """
+    if path_delays is None:
+        path_delays = {}  # Overall delay per path, shared across shaping parameters (and flows, if passed in)
+    if arc_costs is None:
+        arc_costs = arc_dual_costs(network, dual_vars)
+    # Neither tree depends on the shaping parameter, so each is built at most once per flow
+    cheapest_tree = cheapest.get(flow.src) if cheapest else None
+    if cheapest_tree is None:
+        cheapest_tree = shortest_path_trees(network, cheapest_path_weights(network, arc_costs), [flow.src])[flow.src]
+    fastest_tree = fastest.get(flow.src) if fastest else None
     best_path = None
     best_b_prime = None
     best_cost = float('inf')
+    min_cost = None  # Dual cost of the cheapest path ignoring delay; no b' can price below it
     for b_prime in possible_shaping_parameters(flow, cycle_duration_T):
         shaping_delay = math.ceil(flow.burst_size / b_prime) * cycle_duration_T + cycle_duration_T
         # Convert shaping_delay from μs to ms for consistency with other delays
@@ -90,11 +235,15 @@ def solve_pricing_problem(flow, network, dual_vars, cycle_duration_T, tau):
         if delay_constraint < 0:
             continue  
             
-        path = larac_algorithm(network.graph, flow.src, flow.dest, delay_constraint, dual_vars)
+        path = larac_algorithm(network, flow.src, flow.dest, delay_constraint, dual_vars, arc_costs,
+                               cheapest_tree, fastest_tree)
         
         if path:
             # Calculate the actual path delay including propagation and tau values
-            path_delay = calculate_overall_delay(network, path, cycle_duration_T, tau)
+            path_key = tuple(path)
+            path_delay = path_delays.get(path_key)
+            if path_delay is None:
+                path_delay = path_delays[path_key] = calculate_overall_delay(network, path, cycle_duration_T, tau)
             
             # Check if the total delay (shaping delay + path delay) satisfies the max E2E delay constraint
             if shaping_delay_ms + path_delay <= flow.max_e2e_delay:
@@ -103,32 +252,58 @@ def solve_pricing_problem(flow, network, dual_vars, cycle_duration_T, tau):
                     best_path = path
                     best_b_prime = b_prime
                     best_cost = cost
+                    # Larger b' can only tie the lower bound, and ties keep the smaller b'
+                    if min_cost is None:
+                        # The tree's distances include the tie-breaking delay term, so price its path directly
+                        cheapest_path = tree_path(network, cheapest_tree, flow.dest)
+                        min_cost = sum(dual_vars.get(hop, 0) for hop in zip(cheapest_path[:-1], cheapest_path[1:]))
+                    if best_cost <= min_cost:
+                        break
     
     return best_path, best_b_prime
 
 
-def add_new_columns(columns, dual_vars, network, flows, cycle_duration_T, tau):
-    """Add new columns to the RMP based on the pricing problem."""
+def add_new_columns(columns, dual_vars, network, flows, cycle_duration_T, tau, fastest=None, column_keys=None):
+    """
+    Add new columns to the RMP based on the pricing problem.
+    column_keys is the set of (flow, path tuple, b') keys of columns, kept in step with columns across calls.
+    """
     new_columns_added = False
+    if column_keys is None:
+        column_keys = {(f, tuple(p), b) for f, p, b in columns}
+    # The cheapest path from a source only depends on the duals, so the trees of all sources are
+    # built in one Dijkstra run and shared by every flow priced in this iteration. With the delay
+    # tie-break, the path read off a tree is the lowest-delay one among the cheapest, so it does
+    # not depend on how csgraph orders equal-cost candidates
+    arc_costs = arc_dual_costs(network, dual_vars)
+    cheapest = shortest_path_trees(network, cheapest_path_weights(network, arc_costs),
+                                   dict.fromkeys(flow.src for flow in flows))
+    path_delays = {}  # Path delays computed by one pricing subproblem are reused by the others
     for flow in flows:
         # Solve the pricing problem to find the best path and shaping parameter
-        best_path, best_b_prime = solve_pricing_problem(flow, network, dual_vars, cycle_duration_T, tau)
+        best_path, best_b_prime = solve_pricing_problem(flow, network, dual_vars, cycle_duration_T, tau, path_delays,
+                                                        arc_costs, cheapest, fastest)
         if best_path and best_b_prime:
             # Check if the new column improves the objective
             new_column = (flow, best_path, best_b_prime)
-            if new_column not in columns:
+            column_key = (flow, tuple(best_path), best_b_prime)
+            if column_key not in column_keys:
+                column_keys.add(column_key)
                 columns.append(new_column)
                 new_columns_added = True
     return new_columns_added
 
 
-def can_add_to_solution(current_solution, selected, network, cycle_duration_T):
+def can_add_to_solution(selected, used_capacity, network, cycle_duration_T):
+    """Check a column against the remaining link capacity and, if it fits, reserve its b' on its links."""
     flow, path, b_prime = selected
-    for u, v in zip(path[:-1], path[1:]):
-        link_capacity = network.bandwidths.get((u, v), 0)
-        used_capacity = sum(b for (f, p, b), z in current_solution.items() if z == 1 and (u, v) in zip(p[:-1], p[1:]))
-        if used_capacity + b_prime > link_capacity * cycle_duration_T:
+    selected_edges = _path_edges(path)
+    for e in selected_edges:
+        link_capacity = network.bandwidths.get(e, 0)
+        if used_capacity.get(e, 0) + b_prime > link_capacity * cycle_duration_T:
             return False
+    for e in selected_edges:
+        used_capacity[e] = used_capacity.get(e, 0) + b_prime
     return True
 
 
@@ -139,26 +314,39 @@ def calculate_objective(solution, flows):
 def cgrr_algorithm(network, flows, cycle_duration_T, tau, max_rounding_steps=100):
     """Column Generation with Randomized Rounding (CGRR) algorithm."""
     columns = []  # List of (flow, path, shaping_parameter) tuples
+    column_keys = set()  # The same columns as hashable keys, for membership tests
     dual_vars = {}  # Dual variables for capacity constraints
+    capacities = link_capacities(network, cycle_duration_T)
+    if network.node_index is None:
+        network.finalize()
+    # The fastest path from each source does not depend on the duals, so it is computed once
+    fastest = shortest_path_trees(network, network.delay_arr[network.edge_ids], dict.fromkeys(flow.src for flow in flows))
     while True:
-        rmp_solution, dual_vars = solve_rmp(columns, network, cycle_duration_T)
-        if not add_new_columns(columns, dual_vars, network, flows, cycle_duration_T, tau):
+        rmp_solution, dual_vars = solve_rmp(columns, network, cycle_duration_T, capacities)
+        if not add_new_columns(columns, dual_vars, network, flows, cycle_duration_T, tau, fastest, column_keys):
             break  # Exit the loop if no new columns are added
     base_solution = {(f, p, b): z for (f, p, b), z in rmp_solution.items() if z == 1}
     best_solution = base_solution.copy()
+    # The fractional variables and their weights are fixed during rounding, so the cumulative
+    # distribution is built once and each rounding step draws all of its picks in one search
+    fractional_vars = [(f, p, b) for (f, p, b), z in rmp_solution.items() if 0 < z < 1]
+    cumulative_weights = np.cumsum([rmp_solution[var] for var in fractional_vars])
+    # Capacity used by the integral part of the RMP solution; each rounding step extends a copy of it
+    base_used = {}
+    for (f, p, b) in base_solution:
+        for e in _path_edges(p):
+            base_used[e] = base_used.get(e, 0) + b
     for _ in range(max_rounding_steps):
         current_solution = base_solution.copy()
-        fractional_vars = [(f, p, b) for (f, p, b), z in rmp_solution.items() if 0 < z < 1]
-        for _ in range(len(fractional_vars)):
-            total_fractional = sum(rmp_solution[(f, p, b)] for (f, p, b), z in rmp_solution.items() if 0 < z < 1)
-            if total_fractional <= 0:
-                break
-            probabilities = {
-                (f, p, b): rmp_solution[(f, p, b)] / total_fractional for (f, p, b), z in rmp_solution.items() if 0 < z < 1
-            }
-            selected = random.choices(list(probabilities.keys()), weights=probabilities.values(), k=1)[0]
-            if can_add_to_solution(current_solution, selected, network, cycle_duration_T):
-                current_solution[selected] = 1
+        used_capacity = dict(base_used)
+        if fractional_vars:
+            draws = np.random.random(len(fractional_vars)) * cumulative_weights[-1]
+            picks = np.searchsorted(cumulative_weights, draws, side='right')
+            for i in np.minimum(picks, len(fractional_vars) - 1).tolist():
+                selected = fractional_vars[i]
+                # Picks are drawn with replacement; a column already in the solution changes nothing
+                if selected not in current_solution and can_add_to_solution(selected, used_capacity, network, cycle_duration_T):
+                    current_solution[selected] = 1
         if calculate_objective(current_solution, flows) > calculate_objective(best_solution, flows):
             best_solution = current_solution
     return best_solution 
\ No newline at end of file
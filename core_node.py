@@ -1,8 +1,11 @@
-import threading
+import asyncio
+import logging
 import time
 import math
 from collections import deque
 
+log = logging.getLogger(__name__)
+
 
 class CoreNode:
     def __init__(self, node_id, cycle_duration_T):
@@ -10,16 +13,16 @@ class CoreNode:
         self.cycle_duration_T = cycle_duration_T
         self.queues = [{}, {}, {}]  # 3 FIFO queues per interface (indexed 0, 1, 2)
         self.current_cycle = 0
-        self.last_cycle_time = time.time()-(cycle_duration_T / 1e6)
-        self.lock = threading.Lock()
+        self.last_cycle_time = time.monotonic()-(cycle_duration_T / 1e6)
         self.mapping_table = {} # Mapping table: maps (in_port, in_label) to (out_port, out_label)
+        self.mapping_lut = {}   # Direct lookup: mapping_lut[in_port][out_port][in_label] = (out_port, out_label)
         self.link_delays = {}  # Store delays for each link to neighbors
         self.tau = 0.0  # τ value (ms)
         self.active_queue_index = 0   # Track active queue (0, 1, or 2) during each cycle
         self.connected_nodes = {}   # Connect to other nodes
         self.next_hop_map = {}      # Track which node is the next hop for each flow
-        self.packet_flow_map = {}   # Store the flow ID for each packet (needed for forwarding)
         self.routing_table = {}     # Routing table: maps flow_id to next hop
+        self.inbox = deque()        # (in_port, packets) batches handed over by neighbours, drained every cycle
 
     def add_mapping(self, in_port, in_label, out_port, out_label):
         """
@@ -35,6 +38,13 @@ class CoreNode:
         else:
             # Create a new list of outport options
             self.mapping_table[(in_port, in_label)] = [(out_port, out_label)]
+        # Index the entry by outport as well, keeping the first mapping like the linear scan would
+        out_labels = self.mapping_lut.setdefault(in_port, {}).setdefault(out_port, [None, None, None])
+        if out_labels[in_label] is None:
+            out_labels[in_label] = (out_port, out_label)
+        # Every outport a mapping can point to has a queue, so forwarding never adds dict keys
+        for queue in self.queues:
+            queue.setdefault(out_port, deque())
 
     def set_link_delay(self, neighbor_node, delay):
         self.link_delays[neighbor_node] = delay
@@ -45,10 +55,20 @@ class CoreNode:
 
     def connect_to_node(self, node_id, node):
         self.connected_nodes[node_id] = node
+        # Pre-seed a FIFO per outport so the queue dicts don't change shape while forwarding
+        for queue in self.queues:
+            queue.setdefault(node_id, deque())
 
     def set_routing_entry(self, flow_id, next_hop):
         self.routing_table[flow_id] = next_hop
 
+    def set_routing_table(self, routing_table):
+        """Add a batch of routing entries, mapping each flow_id to its next hop."""
+        self.routing_table.update(routing_table)
+
+    def set_flow_completed_callback(self, callback):
+        """Core nodes do not originate flows, so they never report a completed one."""
+
     def learn_mappings(self, upstream_node_id, in_port, out_port=None):
         """
         Learn the mappings between input labels from an upstream node and output labels.
@@ -73,115 +93,135 @@ class CoreNode:
             # Use all neighbors except the inport as potential outports
             outports = [n for n in neighbors if n != in_port]
         
+        # The output label depends on the input label and the cycle shift; it is the same for every outport
+        shift = cycles_to_shift % 3
+        out_labels = [(in_label + shift) % 3 for in_label in range(3)]
+        
         # Map each possible input label (0, 1, 2) to the appropriate output label for each possible outport
         for out_port in outports:
-            for in_label in range(3):
-                # The output label depends on the input label and the cycle shift
-                out_label = (in_label + cycles_to_shift) % 3
-                
+            for in_label, out_label in enumerate(out_labels):
                 # Store the mapping with outport information
                 self.add_mapping(in_port, in_label, out_port, out_label)
 
     def receive_packet(self, packet, in_port):
+        """Process a single incoming packet."""
+        self.receive_packets((packet,), in_port)
+
+    def receive_packets(self, packets, in_port):
         """
-        Process an incoming packet:
+        Process a batch of packets arriving on the same in_port. For each packet:
         1. Determine the output port and new label based on the mapping table
         2. Enqueue the packet in the appropriate queue
-        3. Store the flow ID for later forwarding
         """
-        with self.lock:
+        debug = log.isEnabledFor(logging.DEBUG)
+        port_lut = self.mapping_lut.get(in_port, {})
+        for packet in packets:
             in_label = packet.label
             flow_id = packet.flow_id
-            # Store the flow ID for this packet
-            self.packet_flow_map[id(packet)] = flow_id
             
             # Check if this node is the final destination for this flow
-            if flow_id in self.routing_table:
-                next_hop = self.routing_table.get(flow_id)
-                
-                # Check if mapping exists
-                if (in_port, in_label) in self.mapping_table:
-                    # Find the appropriate mapping entry that matches the next_hop
-                    mapping_options = self.mapping_table[(in_port, in_label)]
-                    
-                    # Use the first mapping option by default
-                    out_port, out_label = mapping_options[0]
-                    
-                    # But if we have a next_hop from the routing table, use that specific outport
-                    if next_hop:
-                        for port, label in mapping_options:
-                            if port == next_hop:
-                                out_port = port
-                                out_label = label
-                                break
-                    
-                    # Assign the new label to the packet
-                    packet.label = out_label
-                    
-                    # Determine which queue to place the packet in
-                    queue_index = out_label % 3
-                    
-                    # Create queue for this port if it doesn't exist
-                    if out_port not in self.queues[queue_index]:
-                        self.queues[queue_index][out_port] = deque()
-                    
-                    # Enqueue the packet
-                    self.queues[queue_index][out_port].append(packet)
-                    
-                    # Use node role in the log message
-                    node_role = "CoreNode"
-                    print(f"{node_role} {self.node_id}: Received packet from flow {packet.flow_id} from in_port {in_port} with label {in_label}, enqueued for out_port {out_port} with new label {out_label} in queue {queue_index}")
-                else:
-                    print(f"Node {self.node_id}: No mapping found for packet from in_port {in_port} with label {in_label}")
+            if flow_id not in self.routing_table:
+                if debug:
+                    log.debug("EgressNode %s: Received packet from flow %s from in_port %s - final destination reached for flow %s",
+                              self.node_id, flow_id, in_port, flow_id)
+                continue
+            next_hop = self.routing_table[flow_id]
+            
+            # Look up the mapping for the routed next hop directly
+            out_labels = port_lut.get(next_hop)
+            entry = out_labels[in_label] if out_labels is not None and in_label < len(out_labels) else None
+            if entry is not None:
+                out_port, out_label = entry
+            elif (in_port, in_label) in self.mapping_table:
+                # No mapping towards the next hop, use the first mapping option by default
+                out_port, out_label = self.mapping_table[(in_port, in_label)][0]
             else:
-                # This node is the final destination for this flow
-                print(f"EgressNode {self.node_id}: Received packet from flow {flow_id} from in_port {in_port} - final destination reached for flow {flow_id}")
+                log.warning("Node %s: No mapping found for packet from in_port %s with label %s",
+                            self.node_id, in_port, in_label)
+                continue
+            
+            # Assign the new label to the packet
+            packet.label = out_label
+            
+            # Determine which queue to place the packet in
+            queue_index = out_label % 3
+            
+            # Enqueue the packet (outport queues are pre-seeded, so this never adds a key)
+            self.queues[queue_index][out_port].append(packet)
+            
+            if debug:
+                log.debug("CoreNode %s: Received packet from flow %s from in_port %s with label %s, "
+                          "enqueued for out_port %s with new label %s in queue %s",
+                          self.node_id, flow_id, in_port, in_label, out_port, out_label, queue_index)
+
+    def deliver_packets(self, packets, in_port):
+        """Hand a batch of packets to this node; they are processed at the start of its next cycle."""
+        self.inbox.append((in_port, packets))
+
+    def drain_inbox(self):
+        """
+        Process every batch delivered since the last cycle. Batches from the same in_port are merged,
+        keeping their arrival order, so each port's mapping is looked up once per cycle.
+        """
+        inbox = self.inbox
+        if not inbox:
+            return
+        by_port = {}
+        while inbox:
+            in_port, packets = inbox.popleft()
+            by_port.setdefault(in_port, []).extend(packets)
+        for in_port, packets in by_port.items():
+            self.receive_packets(packets, in_port)
 
     def transmit_packets(self):
         """
         Transmit packets from the active queue for the current cycle.
         Only one queue is open (active) at any time, following round-robin scheduling.
         """
-        with self.lock:
-            # Get the currently active queue
-            active_queue = self.queues[self.active_queue_index]
-            
-            # Process packets in all output ports for this queue
-            for out_port, queue in list(active_queue.items()):  # Create a copy of items to avoid mutation during iteration
-                while queue:
-                    packet = queue.popleft()
-                    print(f"CoreNode {self.node_id}: Transmitting packet from flow {packet.flow_id} with label {packet.label} to port {out_port} in cycle {self.current_cycle}")
-                    
-                    # Forward packet to the next node
-                    flow_id = self.packet_flow_map.get(id(packet))
-                    if flow_id is not None:
-                        next_hop = self.routing_table.get(flow_id)
-                        if next_hop and next_hop in self.connected_nodes:
-                            next_node = self.connected_nodes[next_hop]
-                            print(f"CoreNode {self.node_id}: Forwarded packet from flow {flow_id} to node {next_hop}")
-                            next_node.receive_packet(packet, self.node_id)
-                        else:
-                            print(f"CoreNode {self.node_id}: Packet destination reached or routing not available for flow {flow_id}")
-                            # Clean up the packet flow mapping
-                            if id(packet) in self.packet_flow_map:
-                                del self.packet_flow_map[id(packet)]
-                    else:
-                        print(f"CoreNode {self.node_id}: Unable to determine flow ID for packet")
-            
-            # Move to the next queue (round-robin)
-            self.active_queue_index = (self.active_queue_index + 1) % 3
-            self.current_cycle += 1
-        self.last_cycle_time = time.time()
+        # Get the currently active queue
+        active_queue = self.queues[self.active_queue_index]
+        debug = log.isEnabledFor(logging.DEBUG)
+        
+        # Packets are handed to each neighbour as one batch once the queue has been drained
+        outgoing = {}
         
-    def run(self):
-        """Simulate the core node's operation over time. """
-       
+        # Process packets in all output ports for this queue
+        for out_port, queue in active_queue.items():  # Keys are fixed at setup, so no copy is needed
+            while queue:
+                packet = queue.popleft()
+                if debug:
+                    log.debug("CoreNode %s: Transmitting packet from flow %s with label %s to port %s in cycle %s",
+                              self.node_id, packet.flow_id, packet.label, out_port, self.current_cycle)
+                
+                # Forward packet to the next node
+                flow_id = packet.flow_id
+                next_hop = self.routing_table.get(flow_id)
+                if next_hop and next_hop in self.connected_nodes:
+                    if debug:
+                        log.debug("CoreNode %s: Forwarded packet from flow %s to node %s", self.node_id, flow_id, next_hop)
+                    outgoing.setdefault(next_hop, []).append(packet)
+                else:
+                    log.warning("CoreNode %s: Packet destination reached or routing not available for flow %s",
+                                self.node_id, flow_id)
+        
+        for next_hop, batch in outgoing.items():
+            self.connected_nodes[next_hop].deliver_packets(batch, self.node_id)
+        
+        # Move to the next queue (round-robin)
+        self.active_queue_index = (self.active_queue_index + 1) % 3
+        self.current_cycle += 1
+        self.last_cycle_time = time.monotonic()
+    
+    async def run(self):
+        """
+        Simulate the core node's operation over time, running one transmission per cycle.
+        All nodes run as tasks on one event loop, so a cycle is never interleaved with another node's.
+        """
+        cycle_seconds = self.cycle_duration_T / 1e6  # Convert to seconds
+        next_deadline = self.last_cycle_time + cycle_seconds
         while True:
-            # Check if it's time to start a new cycle
-            current_time = time.time()
-            if current_time - self.last_cycle_time >= self.cycle_duration_T / 1e6:  # Convert to seconds
-                self.transmit_packets()
-                self.last_cycle_time = current_time
-
-            # Simulate some delay between cycles
-            time.sleep(0.1) 
\ No newline at end of file
+            # Yield to the other nodes until the start of the next cycle
+            await asyncio.sleep(max(0.0, next_deadline - time.monotonic()))
+            self.drain_inbox()
+            self.transmit_packets()
+            next_deadline += cycle_seconds
@@ -1,6 +1,9 @@
+import argparse
+import asyncio
 import json
+import logging
+import os
 import sys
-import threading
 import time
 from collections import deque
 import math
@@ -10,40 +13,94 @@ from models import Flow, generate_random_flows, display_flows
 from network import Network, calculate_overall_delay
 from core_node import CoreNode
 from ingress_node import IngressNode
-from algorithms import cgrr_algorithm
+from algorithms import cgrr_algorithm, prefilter_flows
+
+try:
+    import orjson  # Optional, much faster JSON encoder
+except ImportError:
+    orjson = None
+
+
+def encode_json(obj):
+    """Encode obj as JSON bytes indented by two spaces."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, indent=2).encode()
+
+
+def write_file_atomic(path, data):
+    """Replace the file at path with data; readers never see a half-written file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_results(path, simulation_results):
+    """Write the simulation results as indented JSON and return the encoded document."""
+    data = encode_json(simulation_results)
+    write_file_atomic(path, data)
+    return data
+
+
+def save_status(path, results_json, status):
+    """
+    Rewrite the results with the status fields added as top-level keys. results_json is the document
+    returned by save_results, so the flows are not encoded again.
+    """
+    # Both documents are indented the same way, so the status object's members can be spliced in
+    # in place of the closing brace of the results object
+    data = results_json.rstrip()[:-1].rstrip() + b",\n" + encode_json(status)[2:]
+    write_file_atomic(path, data)
+
+
+async def run_nodes(nodes, flow_completed_callback, timeout_seconds):
+    """
+    Run every node as a task on one event loop until all flows complete or the timeout expires.
+    flow_completed_callback is called with the ID of each completed flow and returns True once all have completed.
+    """
+    # The event belongs to the running loop, so it is created here rather than before asyncio.run
+    all_flows_completed = asyncio.Event()
+
+    def on_flow_completed(flow_id):
+        if flow_completed_callback(flow_id):
+            all_flows_completed.set()
+
+    # Set the callback on all nodes; only ingress nodes ever report a completed flow
+    for node in nodes.values():
+        node.set_flow_completed_callback(on_flow_completed)
+    tasks = [asyncio.create_task(node.run()) for node in nodes.values()]
+    try:
+        await asyncio.wait_for(all_flows_completed.wait(), timeout_seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def main():
-    # Check for random flow generation flag
-    use_random_flows = False
-    random_flow_count = 0
-    output_json_file = None
-    
     # Process command line arguments
-    config_file = 'network_config.json'
-    for i, arg in enumerate(sys.argv[1:], 1):
-        if arg == '--random':
-            use_random_flows = True
-            # Check if next argument is a number for flow count
-            if i < len(sys.argv) - 1 and sys.argv[i+1].isdigit():
-                random_flow_count = int(sys.argv[i+1])
-            else:
-                # Prompt user for flow count if not provided
-                random_flow_count = int(input("Enter the number of random flows to generate: "))
-        elif arg == '--output':
-            # Check if next argument is the output file name
-            if i < len(sys.argv) - 1:
-                output_json_file = sys.argv[i+1]
-            else:
-                # Default output file name
-                output_json_file = 'simulation_results.json'
-        elif not arg.startswith('--') and i == 1:
-            # First non-flag argument is the config file
-            config_file = arg
+    parser = argparse.ArgumentParser(description="Time-deterministic network simulation")
+    parser.add_argument('config', nargs='?', default='network_config.json',
+                        help="network configuration file (default: network_config.json)")
+    parser.add_argument('--random', type=int, metavar='N', dest='random_flow_count',
+                        help="generate N random flows instead of loading the flows from the configuration")
+    parser.add_argument('--output', nargs='?', const='simulation_results.json', default='simulation_results.json',
+                        metavar='FILE', help="file to save the results to (default: simulation_results.json)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="log every packet reception and transmission")
+    args = parser.parse_args()
+    config_file = args.config
+    use_random_flows = args.random_flow_count is not None
+    random_flow_count = args.random_flow_count
+    output_json_file = args.output
+    verbose = args.verbose
     
-    # If no output file specified but user wants JSON output, set a default
-    if output_json_file is None:
-        output_json_file = 'simulation_results.json'
+    # Per-packet traces from the nodes are only emitted at DEBUG level
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="%(message)s")
     
     # Load configuration from JSON file
     try:
@@ -66,6 +123,8 @@ def main():
                 bandwidth=link['bandwidth']
             )
         
+        # Build the array form of the topology used by the delay computations
+        network.finalize()
         tau = network.calculate_tau_values(cycle_duration_T)
                 
         # Either load flows from config or generate random flows
@@ -90,8 +149,13 @@ def main():
         # Display loaded flows
         display_flows(flows)
         
+        # Flows that cannot meet their delay bound on any path are left out of the CGRR pricing
+        candidate_flows, infeasible_flows = prefilter_flows(network, flows, cycle_duration_T, tau)
+        if infeasible_flows:
+            print(f"{len(infeasible_flows)} flows cannot meet their delay bound on any path and are not priced")
+        
         # Run the CGRR algorithm to find the best solution
-        best_solution = cgrr_algorithm(network, flows, cycle_duration_T, tau)
+        best_solution = cgrr_algorithm(network, candidate_flows, cycle_duration_T, tau)
         
         # Dictionary to store all nodes (both ingress and core)
         nodes = {}
@@ -106,18 +170,13 @@ def main():
             if node_id not in nodes:
                 nodes[node_id] = CoreNode(node_id, cycle_duration_T)
         
-        # Connect nodes to each other based on the network topology
-        for node1, node2 in network.graph.edges():
+        # Connect nodes to each other and set their link delays in one pass over the configured links
+        for link in network_config['links']:
+            node1, node2, delay = link['node1'], link['node2'], link['delay']
             nodes[node1].connect_to_node(node2, nodes[node2])
             nodes[node2].connect_to_node(node1, nodes[node1])
-        
-        # Set link delays for each node
-        for node1, node2, data in network.graph.edges(data=True):
-            # Check if the node is a CoreNode before calling set_link_delay
-            if isinstance(nodes[node1], CoreNode):
-                nodes[node1].set_link_delay(node2, network.delays[(node1, node2)])
-            if isinstance(nodes[node2], CoreNode):
-                nodes[node2].set_link_delay(node1, network.delays[(node1, node2)])
+            nodes[node1].set_link_delay(node2, delay)
+            nodes[node2].set_link_delay(node1, delay)
         
         # Set tau values for each node
         for node_id, node_tau in tau.items():
@@ -125,36 +184,51 @@ def main():
                 nodes[node_id].set_tau(node_tau)
         
         admitted_flows = set()
-        flow_paths = {}
-        flow_shaping_parameters = {}
+        flow_admissions = {}  # flow_id -> (path, shaping_parameter) of each admitted flow
         
-        # Set up flow paths and routing entries
+        # Set up flow paths, and build the routing table of every node in the same pass
+        routing_tables = {}  # node_id -> {flow_id: next hop}
         for (flow, path, shaping_parameter), z in best_solution.items():
             if z == 1: 
                 flow_id = flow.flow_id
                 admitted_flows.add(flow_id)
-                flow_paths[flow_id] = path
-                flow_shaping_parameters[flow_id] = shaping_parameter
+                flow_admissions[flow_id] = (path, shaping_parameter)
                 
                 # Set the flow path in the source node (which is the ingress node for this flow)
                 source_node = nodes[flow.src]
                 source_node.set_flow_path(flow_id, path)
                 
-                # Set up routing entries for core nodes along the path
-                for i in range(len(path) - 1): 
-                    current_node = path[i]
-                    next_node = path[i + 1]
-                    # Only set routing entries for core nodes
-                    if isinstance(nodes[current_node], CoreNode):
-                        nodes[current_node].set_routing_entry(flow_id, next_node)
+                # Route the flow at every node along the path
+                for current_node, next_node in zip(path[:-1], path[1:]):
+                    routing_tables.setdefault(current_node, {})[flow_id] = next_node
         
-        # Learn mappings for each core node
-        for (node1, node2) in network.graph.edges():
-            # For each edge, have both nodes learn mappings from the other node
+        # Install each node's routing table in one go
+        for node_id, routing_table in routing_tables.items():
+            nodes[node_id].set_routing_table(routing_table)
+        
+        # Learn mappings for each core node, once every node knows all of its neighbours
+        for link in network_config['links']:
+            node1, node2 = link['node1'], link['node2']
+            # For each link, have both nodes learn mappings from the other node
             nodes[node1].learn_mappings(node2, in_port=node2)
             nodes[node2].learn_mappings(node1, in_port=node1)
         
-        # Prepare data for JSON output
+        # Prepare data for JSON output, with one admission lookup per flow
+        flows_payload = []
+        for flow in flows:
+            path, shaping_parameter = flow_admissions.get(flow.flow_id, ([], None))
+            flows_payload.append({
+                "flow_id": flow.flow_id,
+                "arrival_rate": flow.arrival_rate,
+                "burst_size": flow.burst_size,
+                "max_e2e_delay": flow.max_e2e_delay,
+                "max_pkt_size": flow.max_pkt_size,
+                "src": flow.src,
+                "dest": flow.dest,
+                "admitted": flow.flow_id in admitted_flows,
+                "path": path,
+                "shaping_parameter": shaping_parameter
+            })
         simulation_results = {
             "simulation_parameters": {
                 "cycle_duration_T": cycle_duration_T
@@ -163,57 +237,34 @@ def main():
                 "nodes": network_config["nodes"],
                 "links": network_config["links"],
             },
-            "flows": [
-                {
-                    "flow_id": flow.flow_id,
-                    "arrival_rate": flow.arrival_rate,
-                    "burst_size": flow.burst_size,
-                    "max_e2e_delay": flow.max_e2e_delay,
-                    "max_pkt_size": flow.max_pkt_size,
-                    "src": flow.src,
-                    "dest": flow.dest,
-                    "admitted": flow.flow_id in admitted_flows,
-                    "path": flow_paths.get(flow.flow_id, []),
-                    "shaping_parameter": flow_shaping_parameters.get(flow.flow_id, None)
-                }
-                for flow in flows
-            ],
+            "flows": flows_payload,
             "admitted_flows_count": len(admitted_flows),
             "total_flows_count": len(flows)
         }
         
-        # Write results to JSON file
-        with open(output_json_file, 'w') as f:
-            json.dump(simulation_results, f, indent=2)
+        # Write results to JSON file; later status updates reuse the encoded document
+        results_json = save_results(output_json_file, simulation_results)
         
         print(f"\nSimulation results have been saved to {output_json_file}")
         
-        # Start all nodes in separate threads
-        threads = {}
-        for node_id, node in nodes.items():
-            threads[node_id] = threading.Thread(target=node.run, daemon=True)
-            threads[node_id].start()
-        
         # Setup flow completion tracking
         if admitted_flows:
             flow_completion_status = {flow_id: False for flow_id in admitted_flows}
-            all_flows_completed = threading.Event()
+            flows_remaining = len(flow_completion_status)
             
             # Callback function for flow completion
             def flow_completed_callback(flow_id):
+                nonlocal flows_remaining
                 flow_id = int(flow_id)  # Ensure flow_id is an integer
                 if flow_id in flow_completion_status:
-                    flow_completion_status[flow_id] = True
+                    # Count each flow once, even if it was shaped onto more than one path
+                    if not flow_completion_status[flow_id]:
+                        flow_completion_status[flow_id] = True
+                        flows_remaining -= 1
                     print(f"✓ Flow {flow_id} has fully completed processing")
-                    
-                    # Check if all flows have completed
-                    if all(flow_completion_status.values()):
-                        all_flows_completed.set()
-            
-            # Set the callback on all ingress nodes
-            for node_id, node in nodes.items():
-                if isinstance(node, IngressNode):
-                    node.set_flow_completed_callback(flow_completed_callback)
+                
+                # Check if all flows have completed
+                return flows_remaining == 0
         else:
             print("No flows were admitted. Exiting.")
             return
@@ -231,22 +282,21 @@ def main():
             if flow.flow_id not in admitted_flows:
                 print(f"❌ Flow {flow.flow_id} is NOT admitted due to constraints.")
         
-        # Keep the main thread alive to allow nodes to process flows
+        # Run the nodes until all flows complete or a reasonable duration has passed
         try:
-            # Wait for all flows to complete or timeout after a reasonable duration
             timeout_seconds = 60  # Adjust as needed based on expected flow completion time
-            flows_completed = all_flows_completed.wait(timeout_seconds)
+            flows_completed = asyncio.run(run_nodes(nodes, flow_completed_callback, timeout_seconds))
             
             if flows_completed:
                 print("\nAll flows have completed processing. Simulation successful!")
                 
                 # Update completion status in the JSON file
-                simulation_results["simulation_complete"] = True
-                simulation_results["completion_status"] = {
-                    str(flow_id): completed for flow_id, completed in flow_completion_status.items()
-                }
-                with open(output_json_file, 'w') as f:
-                    json.dump(simulation_results, f, indent=2)
+                save_status(output_json_file, results_json, {
+                    "simulation_complete": True,
+                    "completion_status": {
+                        str(flow_id): completed for flow_id, completed in flow_completion_status.items()
+                    }
+                })
                 print(f"Updated simulation results with completion status in {output_json_file}")
             else:
                 print(f"\nTimeout reached after {timeout_seconds} seconds. Some flows did not complete:")
@@ -257,20 +307,20 @@ def main():
                         incomplete_flows.append(flow_id)
                 
                 # Update timeout status in the JSON file
-                simulation_results["simulation_complete"] = False
-                simulation_results["timeout_reached"] = True
-                simulation_results["incomplete_flows"] = incomplete_flows
-                with open(output_json_file, 'w') as f:
-                    json.dump(simulation_results, f, indent=2)
+                save_status(output_json_file, results_json, {
+                    "simulation_complete": False,
+                    "timeout_reached": True,
+                    "incomplete_flows": incomplete_flows
+                })
                 print(f"Updated simulation results with timeout information in {output_json_file}")
         except KeyboardInterrupt:
             print("Stopping the nodes early due to keyboard interrupt.")
             
             # Update keyboard interrupt status in the JSON file
-            simulation_results["simulation_complete"] = False
-            simulation_results["keyboard_interrupt"] = True
-            with open(output_json_file, 'w') as f:
-                json.dump(simulation_results, f, indent=2)
+            save_status(output_json_file, results_json, {
+                "simulation_complete": False,
+                "keyboard_interrupt": True
+            })
             print(f"Updated simulation results with interruption information in {output_json_file}")
     
     except FileNotFoundError:
@@ -1,4 +1,16 @@
+from collections import deque
+import numpy as np
+
+
+# Packed per-packet record used to hold shaped packets at the ingress in SoA form
+PACKET_DTYPE = np.dtype([('flow_id', np.int32), ('size', np.float64), ('label', np.int32)])
+
+# Remainders below this fraction of the max packet size are float residue, not a packet
+PACKET_SIZE_TOLERANCE = 1e-9
+
 class Packet:
+    __slots__ = ('size', 'flow_id', 'label')  # No per-instance __dict__; one object per packet in flight
+
     def __init__(self, size, flow_id, label=None):
         self.size = size  # Size of the packet in KB
         self.flow_id = flow_id  # Identifier for the flow
@@ -6,6 +18,9 @@ class Packet:
 
 
 class Flow:
+    __slots__ = ('flow_id', 'arrival_rate', 'burst_size', 'max_e2e_delay', 'max_pkt_size', 'src', 'dest',
+                 'packet_sizes', '_packets')
+
     def __init__(self, flow_id, arrival_rate, burst_size, max_e2e_delay, max_pkt_size, src, dest):
         self.flow_id = flow_id  # Identifier for the flow
         self.arrival_rate = arrival_rate  # Rate at which packets arrive (e.g., Mbps)
@@ -14,7 +29,8 @@ class Flow:
         self.max_pkt_size = max_pkt_size  # Maximum packet size (e.g., KB)
         self.src = src  # Source node
         self.dest = dest  # Destination node
-        self.packets = []  # Queue of packets in the flow
+        self.packet_sizes = np.empty(0)  # Size of each packet in the burst (KB), set by generate_packets
+        self._packets = None
     
     def __repr__(self):
         return f"Flow-{self.flow_id}" 
@@ -22,15 +38,23 @@ class Flow:
     def __str__(self):
         return f"Flow-{self.flow_id}"
 
+    @property
+    def packets(self):
+        """Queue of packets in the flow, built from packet_sizes on first use."""
+        if self._packets is None:
+            self._packets = deque(Packet(size, self.flow_id) for size in self.packet_sizes.tolist())
+        return self._packets
+
     def generate_packets(self):
         """Simulate packet generation for the flow based on the burst size."""
-        from collections import deque
-        self.packets = deque()
-        remaining_burst = self.burst_size
-        while remaining_burst > 0:
-            packet_size = min(self.max_pkt_size, remaining_burst)
-            self.packets.append(Packet(packet_size, self.flow_id))
-            remaining_burst -= packet_size
+        # The burst is cut into as many max-size packets as fit, plus one packet for the remainder
+        num_full = int(self.burst_size // self.max_pkt_size)
+        remainder = self.burst_size - num_full * self.max_pkt_size
+        has_remainder = remainder > PACKET_SIZE_TOLERANCE * self.max_pkt_size
+        self.packet_sizes = np.full(num_full + has_remainder, self.max_pkt_size, dtype=np.float64)
+        if has_remainder:
+            self.packet_sizes[-1] = remainder
+        self._packets = None
 
 
 def generate_random_flows(num_flows, network_nodes):
@@ -44,41 +68,38 @@ def generate_random_flows(num_flows, network_nodes):
     Returns:
         List of Flow objects with random parameters
     """
-    import random
-    flows = []
-    for i in range(1, num_flows + 1):
-        # Randomly select source node
-        src = random.choice(network_nodes)
-        
-        # Create a list of possible destinations (all nodes except source)
-        possible_destinations = [node for node in network_nodes if node != src]
-        
-        # If no valid destinations available (should not happen with normal networks)
-        if not possible_destinations:
-            print(f"Warning: Cannot generate flow {i} - no valid destinations for source {src}")
-            continue
-            
-        # Randomly select destination node
-        dest = random.choice(possible_destinations)
-        
-        # Generate random flow parameters
-        arrival_rate = random.uniform(5, 15)
-        max_pkt_size = random.uniform(1, 2)
-        num_packets = random.randint(3, 8)
-        burst_size = num_packets * max_pkt_size
-        max_e2e_delay = random.uniform(30, 70)
-        
-        flows.append(Flow(
-            flow_id=i,
-            arrival_rate=arrival_rate,
-            burst_size=burst_size,
-            max_e2e_delay=max_e2e_delay,
-            max_pkt_size=max_pkt_size,
-            src=src,
-            dest=dest
-        ))
+    num_nodes = len(network_nodes)
+    # If no valid destinations available (should not happen with normal networks)
+    if num_nodes < 2:
+        print(f"Warning: Cannot generate {num_flows} flows - the network needs at least two nodes")
+        return []
+    
+    # Draw the parameters of all flows at once
+    rng = np.random.default_rng()
+    src_index = rng.integers(0, num_nodes, num_flows)
+    # Offsetting the source by 1..num_nodes-1 picks a destination uniformly among the other nodes
+    dest_index = (src_index + rng.integers(1, num_nodes, num_flows)) % num_nodes
+    arrival_rate = rng.uniform(5, 15, num_flows)
+    max_pkt_size = rng.uniform(1, 2, num_flows)
+    num_packets = rng.integers(3, 9, num_flows)
+    burst_size = num_packets * max_pkt_size
+    max_e2e_delay = rng.uniform(30, 70, num_flows)
     
-    return flows
+    # Only the Flow objects themselves are built in Python, from plain Python values
+    return [
+        Flow(
+            flow_id=flow_id,
+            arrival_rate=rate,
+            burst_size=burst,
+            max_e2e_delay=max_delay,
+            max_pkt_size=pkt_size,
+            src=network_nodes[src],
+            dest=network_nodes[dest]
+        )
+        for flow_id, src, dest, rate, burst, max_delay, pkt_size in zip(
+            range(1, num_flows + 1), src_index.tolist(), dest_index.tolist(), arrival_rate.tolist(),
+            burst_size.tolist(), max_e2e_delay.tolist(), max_pkt_size.tolist())
+    ]
 
 
 def display_flows(flows):
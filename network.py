@@ -1,17 +1,52 @@
 import networkx as nx
-import math
+import numpy as np
 
 
 class Network:
     def __init__(self):
         self.graph = nx.Graph()  # Graph G(V, E)
         self.delays = {}  # Delay for each link e in E
+        self.hop_delays = {}  # Delay of each link keyed by both (node1, node2) and (node2, node1)
         self.bandwidths = {}  # Bandwidth for each link e in E
+        # Array form of the topology, built by finalize()
+        self.node_ids = None  # Node ID at each contiguous node index
+        self.node_index = None  # Contiguous index of each node ID
+        self.delay_arr = None  # Propagation delay (ms) per link index, in the order of delays
+        self.indptr = None  # CSR adjacency: neighbours of node i are indices[indptr[i]:indptr[i + 1]]
+        self.indices = None
+        self.edge_ids = None  # Link index of each CSR entry
+        self.arcs = None  # Directed (u, v) node pair of each CSR entry
+        # τ only depends on the link delays and T, so node τ values are kept until the topology changes
+        self._tau_values_cache = {}  # T -> τ (ms) of every node
 
     def add_link(self, node1, node2, delay, bandwidth):
         self.graph.add_edge(node1, node2, delay=delay)
         self.delays[(node1, node2)] = delay
+        self.hop_delays[(node1, node2)] = self.hop_delays[(node2, node1)] = delay
         self.bandwidths[(node1, node2)] = bandwidth
+        self.node_index = None  # The array form is rebuilt on next use
+        self._tau_values_cache.clear()
+
+    def finalize(self):
+        """
+        Build the array form of the topology: a contiguous node index, a CSR adjacency holding
+        both directions of every link, and the per-link delay array.
+        """
+        self.node_ids = list(self.graph.nodes())
+        self.node_index = {node: i for i, node in enumerate(self.node_ids)}
+        links = list(self.delays)
+        self.delay_arr = np.array([self.delays[link] for link in links], dtype=np.float64)
+
+        num_links = len(links)
+        ends = np.array([(self.node_index[u], self.node_index[v]) for u, v in links], dtype=np.int64).reshape(num_links, 2)
+        rows = np.concatenate([ends[:, 1], ends[:, 0]])
+        cols = np.concatenate([ends[:, 0], ends[:, 1]])
+        link_ids = np.tile(np.arange(num_links), 2)
+        order = np.lexsort((cols, rows))
+        self.indptr = np.searchsorted(rows[order], np.arange(len(self.node_ids) + 1))
+        self.indices = cols[order]
+        self.edge_ids = link_ids[order]
+        self.arcs = [(self.node_ids[u], self.node_ids[v]) for u, v in zip(rows[order].tolist(), self.indices.tolist())]
     
     def calculate_tau(self, upstream_node, downstream_node, cycle_duration_T):
         """
@@ -45,19 +80,10 @@ class Network:
         # Pb is determined by the propagation delay
         reception_end_time = propagation_delay_us + cycle_duration_T
         
-        # Calculate which cycle this corresponds to
-        cycle_number = math.ceil(reception_end_time / cycle_duration_T)
-        
-        # Calculate the start time of the next available cycle (Tb)
-        next_cycle_start = cycle_number * cycle_duration_T
-        
-        # Calculate τ = Tb - Pe
-        # This is the waiting time between packet reception end and next transmission cycle
-        tau_us = next_cycle_start - reception_end_time
-        
-        # Ensure τ is in the range [0, T)
-        if tau_us < 0:
-            tau_us += cycle_duration_T
+        # Calculate τ = Tb - Pe, where Tb = ⌈Pe / T⌉ × T is the start of the next available cycle
+        # This is the waiting time between packet reception end and next transmission cycle;
+        # (-Pe) mod T is the same value, already in the range [0, T)
+        tau_us = (-reception_end_time) % cycle_duration_T
         
         # Convert back to ms for consistency with other delay values
         tau_ms = tau_us / 1000
@@ -74,38 +100,34 @@ class Network:
         Returns:
             tau_values: Dictionary mapping node IDs to their τ values in ms
         """
-        tau_values = {}
+        tau_values = self._tau_values_cache.get(cycle_duration_T)
+        if tau_values is not None:
+            return dict(tau_values)
+        if self.node_index is None:
+            self.finalize()
         
-        # For each node in the graph
-        for node in self.graph.nodes():
-            # Get all neighbors (upstream nodes)
-            neighbors = list(self.graph.neighbors(node))
-            
-            # Calculate tau for each upstream-downstream pair
-            node_taus = {}
-            for upstream in neighbors:
-                tau = self.calculate_tau(upstream, node, cycle_duration_T)
-                if tau is not None:
-                    node_taus[upstream] = tau
-            
-            # If node has tau values, use the average as its tau value
-            if node_taus:
-                avg_tau = sum(node_taus.values()) / len(node_taus)
-                tau_values[node] = avg_tau
-            else:
-                tau_values[node] = 0.0
-                
-        return tau_values
+        # τ only depends on the link's propagation delay, so compute it for every link at once
+        # (same closed form as calculate_tau)
+        reception_end_time = self.delay_arr * 1000 + cycle_duration_T
+        link_tau = np.mod(-reception_end_time, cycle_duration_T) / 1000
+        
+        # Each node's τ is the average over the links to its neighbours (its CSR row), or 0.0 without any
+        degree = np.diff(self.indptr)
+        tau_sums = np.zeros(len(self.node_ids))
+        has_neighbors = degree > 0
+        if has_neighbors.any():
+            tau_sums[has_neighbors] = np.add.reduceat(link_tau[self.edge_ids], self.indptr[:-1][has_neighbors])
+        avg_tau = np.divide(tau_sums, degree, out=np.zeros_like(tau_sums), where=has_neighbors)
+        
+        tau_values = self._tau_values_cache[cycle_duration_T] = dict(zip(self.node_ids, avg_tau.tolist()))
+        return dict(tau_values)
 
 
 def calculate_overall_delay(network, path, T, delay_values):
     """Calculate the total delay for a path, including propagation and tau values."""
-    total_delay = 0.0
-    for i in range(len(path) - 1):
-        current_node = path[i]
-        next_node = path[i + 1]
-        link = (current_node, next_node)
-        propagation_delay = network.delays.get(link, 0.0)
-        tau = delay_values.get(next_node, 0.0)
-        total_delay += propagation_delay + tau + T/1000  # Convert T from μs to ms
-    return total_delay
+    # Paths are only a handful of hops, where per-hop dict lookups beat building arrays for each call;
+    # links can be traversed in either direction
+    hop_delays = network.hop_delays
+    propagation_delay = sum(hop_delays.get(hop, 0.0) for hop in zip(path[:-1], path[1:]))
+    tau = sum(delay_values.get(node, 0.0) for node in path[1:])
+    return propagation_delay + tau + (len(path) - 1) * T / 1000  # Convert T from μs to ms